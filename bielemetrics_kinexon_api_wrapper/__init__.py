@@ -7,6 +7,18 @@ from .fetch_data import (
     fetch_game_csv_data,
     get_available_metrics_and_events,
 )
+from .backfill import (
+    open_work_queue,
+    expand_job_spec,
+    enqueue_sessions,
+    claim_work_item,
+    renew_lease,
+    complete_work_item,
+    fail_work_item,
+    requeue_failed,
+    queue_progress,
+    run_worker,
+)
 
 __all__ = [
     "load_credentials",
@@ -17,4 +29,14 @@ __all__ = [
     "fetch_event_ids",
     "fetch_game_csv_data",
     "get_available_metrics_and_events",
+    "open_work_queue",
+    "expand_job_spec",
+    "enqueue_sessions",
+    "claim_work_item",
+    "renew_lease",
+    "complete_work_item",
+    "fail_work_item",
+    "requeue_failed",
+    "queue_progress",
+    "run_worker",
 ]
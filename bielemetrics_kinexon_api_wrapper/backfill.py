@@ -0,0 +1,738 @@
+"""This module contains a shared work queue for multi-node game backfills.
+
+Work items (one per Kinexon ``session_id``) live in a SQLite database that
+all worker nodes can reach. Workers claim items with expiring leases, so
+games held by a crashed node are picked up again once the lease runs out.
+Completed downloads are written atomically and are keyed by ``session_id``.
+
+Claims are only exclusive if SQLite's file locks work across all nodes. The
+database must live on storage with working POSIX locks (e.g. a local disk of
+a single host, or a cluster filesystem such as CephFS or Lustre). Plain NFS
+and SMB shares are known to break SQLite locking, which can lead to games
+being downloaded by two workers or to a corrupted queue.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+import requests
+from requests import HTTPError
+
+from bielemetrics_kinexon_api_wrapper.api_authenticate import (
+    load_credentials,
+    login,
+)
+from bielemetrics_kinexon_api_wrapper.fetch_data import (
+    fetch_event_ids,
+    fetch_game_csv_data,
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_CLAIMED = "claimed"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 900
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    session_id TEXT PRIMARY KEY,
+    team_id INTEGER,
+    description TEXT,
+    start_session TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    available_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    output_path TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_work_items_status
+    ON work_items (status, available_at);
+"""
+
+
+def open_work_queue(path: str, timeout: float = 60.0) -> sqlite3.Connection:
+    """
+    Open (and create if necessary) the shared work queue database.
+
+    Args:
+        path (str): Path to the SQLite database file.
+        timeout (float): Seconds to wait for a lock held by another worker.
+
+    Returns:
+        sqlite3.Connection: The connection to the work queue.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    # Transactions are managed explicitly (BEGIN IMMEDIATE) so that claiming
+    # an item is a single atomic read-modify-write across all nodes.
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # WAL relies on shared memory and does not work across hosts, so the
+    # queue always uses a rollback journal with full syncs.
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def expand_job_spec(
+    session: requests.Session, base_url: str, job_spec: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Expand a job spec of teams and date ranges into game sessions.
+
+    The job spec has the form::
+
+        {"jobs": [{"team_ids": [5, 32],
+                   "min_time": "2023-12-01 00:00:00",
+                   "max_time": "2023-12-31 23:59:59"}]}
+
+    Args:
+        session (requests.Session): The session object to use.
+        base_url (str): The base URL for the Kinexon API.
+        job_spec (dict): The job spec to expand.
+
+    Returns:
+        list: One dict per unique ``session_id``.
+
+    Raises:
+        Exception: If the event IDs of a team cannot be fetched.
+    """
+    work_items = {}
+
+    for job in job_spec.get("jobs", []):
+        for team_id in job["team_ids"]:
+            result = fetch_event_ids(
+                session, base_url, team_id, job["min_time"], job["max_time"]
+            )
+            if isinstance(result, tuple):
+                status_code, error = result
+                raise Exception(
+                    f"Failed to fetch event IDs for team {team_id}: "
+                    f"{status_code} {error}"
+                )
+
+            for game in result:
+                work_items.setdefault(
+                    str(game["session_id"]),
+                    {
+                        "session_id": str(game["session_id"]),
+                        "team_id": team_id,
+                        "description": game.get("description"),
+                        "start_session": game.get("start_session"),
+                    },
+                )
+
+    return list(work_items.values())
+
+
+def enqueue_sessions(
+    conn: sqlite3.Connection, work_items: Iterable[Dict[str, Any]]
+) -> int:
+    """
+    Add game sessions to the work queue, skipping already known ones.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+        work_items (iterable): Dicts as returned by ``expand_job_spec``.
+
+    Returns:
+        int: The number of newly added work items.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO work_items "
+            "(session_id, team_id, description, start_session, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    str(item["session_id"]),
+                    item.get("team_id"),
+                    item.get("description"),
+                    item.get("start_session"),
+                    now,
+                )
+                for item in work_items
+            ],
+        )
+        added = conn.total_changes - before
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return added
+
+
+def claim_work_item(
+    conn: sqlite3.Connection,
+    worker_id: str,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> Optional[Dict[str, Any]]:
+    """
+    Claim the next available work item with an expiring lease.
+
+    Items are available if they are pending and due, or if the lease of the
+    worker holding them has expired. Items whose lease expired after the
+    last allowed attempt are marked as failed instead.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+        worker_id (str): Unique identifier of the claiming worker.
+        lease_seconds (float): Duration of the lease.
+        max_attempts (int): Number of attempts before an item is failed.
+
+    Returns:
+        dict: The claimed work item, or None if nothing is available.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE work_items SET status = ?, worker_id = NULL, "
+            "last_error = 'lease expired', updated_at = ? "
+            "WHERE status = ? AND lease_expires_at <= ? AND attempts >= ?",
+            (STATUS_FAILED, now, STATUS_CLAIMED, now, max_attempts),
+        )
+        row = conn.execute(
+            "SELECT * FROM work_items "
+            "WHERE (status = ? AND available_at <= ?) "
+            "OR (status = ? AND lease_expires_at <= ?) "
+            "ORDER BY start_session, session_id LIMIT 1",
+            (STATUS_PENDING, now, STATUS_CLAIMED, now),
+        ).fetchone()
+
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute(
+            "UPDATE work_items SET status = ?, worker_id = ?, "
+            "lease_expires_at = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE session_id = ?",
+            (
+                STATUS_CLAIMED,
+                worker_id,
+                now + lease_seconds,
+                now,
+                row["session_id"],
+            ),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    work_item = dict(row)
+    work_item.update(
+        status=STATUS_CLAIMED,
+        worker_id=worker_id,
+        lease_expires_at=now + lease_seconds,
+        attempts=row["attempts"] + 1,
+        updated_at=now,
+    )
+    return work_item
+
+
+def _update_claimed_item(
+    conn: sqlite3.Connection,
+    session_id: str,
+    worker_id: str,
+    assignments: str,
+    values: tuple,
+) -> bool:
+    """Update an item only if the given worker still holds its lease."""
+    cursor = conn.execute(
+        f"UPDATE work_items SET {assignments}, updated_at = ? "
+        "WHERE session_id = ? AND worker_id = ? AND status = ?",
+        values + (time.time(), session_id, worker_id, STATUS_CLAIMED),
+    )
+    return cursor.rowcount == 1
+
+
+def renew_lease(
+    conn: sqlite3.Connection,
+    session_id: str,
+    worker_id: str,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    Extend the lease of a claimed work item.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+        session_id (str): The identifier of the game session.
+        worker_id (str): The worker holding the lease.
+        lease_seconds (float): New duration of the lease from now.
+
+    Returns:
+        bool: False if the lease was lost to another worker.
+    """
+    return _update_claimed_item(
+        conn,
+        session_id,
+        worker_id,
+        "lease_expires_at = ?",
+        (time.time() + lease_seconds,),
+    )
+
+
+def complete_work_item(
+    conn: sqlite3.Connection, session_id: str, worker_id: str, output_path: str
+) -> bool:
+    """
+    Mark a claimed work item as done.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+        session_id (str): The identifier of the game session.
+        worker_id (str): The worker holding the lease.
+        output_path (str): Where the downloaded CSV data was stored.
+
+    Returns:
+        bool: False if the lease was lost to another worker.
+    """
+    return _update_claimed_item(
+        conn,
+        session_id,
+        worker_id,
+        "status = ?, lease_expires_at = NULL, last_error = NULL, "
+        "output_path = ?",
+        (STATUS_DONE, output_path),
+    )
+
+
+def fail_work_item(
+    conn: sqlite3.Connection,
+    session_id: str,
+    worker_id: str,
+    error: str,
+    attempts: int,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+) -> bool:
+    """
+    Release a claimed work item after a failed attempt.
+
+    The item is rescheduled with a linear backoff, or marked as failed once
+    ``max_attempts`` is reached.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+        session_id (str): The identifier of the game session.
+        worker_id (str): The worker holding the lease.
+        error (str): Description of the failure.
+        attempts (int): Number of attempts made so far.
+        max_attempts (int): Number of attempts before an item is failed.
+        retry_delay (float): Base delay in seconds before the next attempt.
+
+    Returns:
+        bool: False if the lease was lost to another worker.
+    """
+    status = STATUS_FAILED if attempts >= max_attempts else STATUS_PENDING
+    return _update_claimed_item(
+        conn,
+        session_id,
+        worker_id,
+        "status = ?, worker_id = NULL, lease_expires_at = NULL, "
+        "available_at = ?, last_error = ?",
+        (status, time.time() + retry_delay * attempts, error),
+    )
+
+
+def requeue_failed(conn: sqlite3.Connection) -> int:
+    """
+    Reset all failed work items so they are attempted again.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+
+    Returns:
+        int: The number of requeued work items.
+    """
+    cursor = conn.execute(
+        "UPDATE work_items SET status = ?, attempts = 0, available_at = 0, "
+        "worker_id = NULL, lease_expires_at = NULL, updated_at = ? "
+        "WHERE status = ?",
+        (STATUS_PENDING, time.time(), STATUS_FAILED),
+    )
+    return cursor.rowcount
+
+
+def queue_progress(conn: sqlite3.Connection) -> Dict[str, int]:
+    """
+    Count the work items per status.
+
+    Args:
+        conn (sqlite3.Connection): The work queue connection.
+
+    Returns:
+        dict: The number of items per status, plus the total.
+    """
+    progress = {
+        STATUS_PENDING: 0,
+        STATUS_CLAIMED: 0,
+        STATUS_DONE: 0,
+        STATUS_FAILED: 0,
+    }
+    for row in conn.execute(
+        "SELECT status, COUNT(*) AS count FROM work_items GROUP BY status"
+    ):
+        progress[row["status"]] = row["count"]
+    progress["total"] = sum(progress.values())
+    return progress
+
+
+def _output_path(output_dir: str, work_item: Dict[str, Any]) -> str:
+    """Build the CSV file name for a work item."""
+    start_session = work_item.get("start_session") or "unknown"
+    start_session = start_session.replace(" ", "_").replace(":", "-")
+    return os.path.join(
+        output_dir,
+        f"{start_session}_game_positions_{work_item['session_id']}.csv",
+    )
+
+
+def _heartbeat(
+    queue_path: str,
+    session_id: str,
+    worker_id: str,
+    lease_seconds: float,
+    stop_event: threading.Event,
+    lease_lost: threading.Event,
+) -> None:
+    """
+    Renew the lease of a work item until ``stop_event`` is set.
+
+    Errors (e.g. a locked database) are logged and retried on the next tick.
+    ``lease_lost`` is set once another worker has taken over the item.
+    """
+    conn = None
+    try:
+        while not stop_event.wait(lease_seconds / 3):
+            try:
+                if conn is None:
+                    conn = open_work_queue(queue_path)
+                if not renew_lease(conn, session_id, worker_id, lease_seconds):
+                    logger.warning(f"Lost lease on session {session_id}")
+                    lease_lost.set()
+                    return
+            except Exception as e:
+                logger.warning(
+                    f"Failed to renew lease on session {session_id}: {e}"
+                )
+                if conn is not None:
+                    conn.close()
+                    conn = None
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def run_worker(
+    queue_path: str,
+    output_dir: str,
+    credentials: Dict[str, str],
+    worker_id: Optional[str] = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+    poll_interval: float = 30.0,
+    wait: bool = True,
+) -> Dict[str, int]:
+    """
+    Claim and download games from the work queue until it is drained.
+
+    While a game is downloading, a background thread renews its lease. The
+    CSV data is written to a temporary file and renamed into place, so
+    partially downloaded games never show up in ``output_dir``.
+
+    Args:
+        queue_path (str): Path to the SQLite work queue.
+        output_dir (str): Directory for the downloaded CSV files.
+        credentials (dict): The credentials as returned by load_credentials.
+        worker_id (str): Unique identifier of this worker.
+        lease_seconds (float): Duration of a lease.
+        max_attempts (int): Number of attempts before an item is failed.
+        retry_delay (float): Base delay in seconds between attempts.
+        poll_interval (float): Seconds to sleep when no item is available.
+        wait (bool): Keep polling while other workers hold unfinished items,
+            so games of a crashed worker are taken over once its lease
+            expires.
+
+    Returns:
+        dict: The number of games this worker completed and failed.
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    os.makedirs(output_dir, exist_ok=True)
+    conn = open_work_queue(queue_path)
+    session = login(credentials)
+    base_url = credentials["ENDPOINT_KINEXON_API"]
+    stats = {"completed": 0, "failed": 0}
+
+    try:
+        while True:
+            work_item = claim_work_item(
+                conn, worker_id, lease_seconds, max_attempts
+            )
+
+            if work_item is None:
+                progress = queue_progress(conn)
+                # Pending items are only waiting for their retry delay.
+                # Claimed items are picked up here if their lease expires.
+                if progress[STATUS_PENDING] == 0 and (
+                    progress[STATUS_CLAIMED] == 0 or not wait
+                ):
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            session_id = work_item["session_id"]
+            output_path = _output_path(output_dir, work_item)
+            stop_event = threading.Event()
+            lease_lost = threading.Event()
+            heartbeat = threading.Thread(
+                target=_heartbeat,
+                args=(
+                    queue_path,
+                    session_id,
+                    worker_id,
+                    lease_seconds,
+                    stop_event,
+                    lease_lost,
+                ),
+                daemon=True,
+            )
+            heartbeat.start()
+            tmp_path = f"{output_path}.{worker_id}.part"
+
+            try:
+                csv_data = fetch_game_csv_data(session, base_url, session_id)
+                # Another worker owns the item now, leave the file to it.
+                if not lease_lost.is_set():
+                    with open(tmp_path, "wb") as file:
+                        file.write(csv_data)
+                    os.replace(tmp_path, output_path)
+            except Exception as e:
+                stop_event.set()
+                heartbeat.join()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                logger.error(
+                    f"Attempt {work_item['attempts']} for session "
+                    f"{session_id} failed: {e}"
+                )
+                released = fail_work_item(
+                    conn,
+                    session_id,
+                    worker_id,
+                    str(e),
+                    work_item["attempts"],
+                    max_attempts,
+                    retry_delay,
+                )
+                if released and work_item["attempts"] >= max_attempts:
+                    stats["failed"] += 1
+                if isinstance(e, HTTPError) and e.response is not None:
+                    if e.response.status_code in (401, 403):
+                        session.close()
+                        session = login(credentials)
+                continue
+
+            stop_event.set()
+            heartbeat.join()
+            if lease_lost.is_set():
+                logger.warning(
+                    f"Lease on session {session_id} was lost during download"
+                )
+            elif complete_work_item(conn, session_id, worker_id, output_path):
+                stats["completed"] += 1
+            else:
+                logger.warning(
+                    f"Lease on session {session_id} expired before completion"
+                )
+
+            progress = queue_progress(conn)
+            logger.info(
+                f"[{worker_id}] {progress[STATUS_DONE]}/{progress['total']} "
+                f"done, {progress[STATUS_CLAIMED]} in progress, "
+                f"{progress[STATUS_FAILED]} failed"
+            )
+    finally:
+        session.close()
+        conn.close()
+
+    return stats
+
+
+def _load_job_spec(path: str) -> Dict[str, Any]:
+    """Load a job spec from a JSON file."""
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Command line entry point for ``kinexon-backfill``.
+
+    Args:
+        argv (list): The command line arguments, defaults to sys.argv.
+
+    Returns:
+        int: The exit code, 1 if the worker gave up on any game.
+    """
+    parser = argparse.ArgumentParser(
+        prog="kinexon-backfill",
+        description="Distribute Kinexon game downloads across worker nodes.",
+    )
+    parser.add_argument(
+        "--queue",
+        required=True,
+        help="Path to the shared SQLite work queue.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    parser_enqueue = subparsers.add_parser(
+        "enqueue", help="Expand a job spec and add its games to the queue."
+    )
+    parser_enqueue.add_argument(
+        "job_spec", help="JSON file with teams and date ranges."
+    )
+
+    parser_work = subparsers.add_parser(
+        "work", help="Claim and download games until the queue is drained."
+    )
+    parser_work.add_argument(
+        "--output-dir", required=True, help="Directory for the CSV files."
+    )
+    parser_work.add_argument(
+        "--worker-id",
+        default=None,
+        help="Unique identifier of this worker (default: hostname-pid).",
+    )
+    parser_work.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help="Seconds before a claim expires unless it is renewed.",
+    )
+    parser_work.add_argument(
+        "--max-attempts",
+        type=int,
+        default=DEFAULT_MAX_ATTEMPTS,
+        help="Number of attempts before a game is marked as failed.",
+    )
+    parser_work.add_argument(
+        "--retry-delay",
+        type=float,
+        default=DEFAULT_RETRY_DELAY,
+        help="Base delay in seconds, multiplied by the attempt number.",
+    )
+    parser_work.add_argument(
+        "--poll-interval",
+        type=float,
+        default=30.0,
+        help="Seconds to sleep when no game is available.",
+    )
+    parser_work.add_argument(
+        "--no-wait",
+        dest="wait",
+        action="store_false",
+        help="Exit once nothing is pending, even if other workers still "
+        "hold claims. Games of a crashed worker then stay claimed until "
+        "another worker is started.",
+    )
+
+    subparsers.add_parser("status", help="Show the progress of the queue.")
+    subparsers.add_parser(
+        "requeue-failed", help="Reset failed games so they are retried."
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        for option in ("lease_seconds", "max_attempts", "poll_interval"):
+            if getattr(args, option) <= 0:
+                parser.error(
+                    f"--{option.replace('_', '-')} must be greater than 0"
+                )
+        if args.retry_delay < 0:
+            parser.error("--retry-delay must not be negative")
+
+    if args.command == "enqueue":
+        credentials = load_credentials()
+        session = login(credentials)
+        try:
+            work_items = expand_job_spec(
+                session,
+                credentials["ENDPOINT_KINEXON_API"],
+                _load_job_spec(args.job_spec),
+            )
+        finally:
+            session.close()
+        conn = open_work_queue(args.queue)
+        added = enqueue_sessions(conn, work_items)
+        conn.close()
+        logger.info(
+            f"Found {len(work_items)} games, added {added} new work items."
+        )
+    elif args.command == "work":
+        stats = run_worker(
+            args.queue,
+            args.output_dir,
+            load_credentials(),
+            worker_id=args.worker_id,
+            lease_seconds=args.lease_seconds,
+            max_attempts=args.max_attempts,
+            retry_delay=args.retry_delay,
+            poll_interval=args.poll_interval,
+            wait=args.wait,
+        )
+        logger.info(
+            f"Worker finished: {stats['completed']} completed, "
+            f"{stats['failed']} failed."
+        )
+        if stats["failed"] > 0:
+            return 1
+    elif args.command == "status":
+        conn = open_work_queue(args.queue)
+        progress = queue_progress(conn)
+        conn.close()
+        for status, count in progress.items():
+            print(f"{status}: {count}")
+    elif args.command == "requeue-failed":
+        conn = open_work_queue(args.queue)
+        requeued = requeue_failed(conn)
+        conn.close()
+        logger.info(f"Requeued {requeued} failed work items.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,6 +15,11 @@ setup(
         "requests",
         "tqdm",
     ],
+    entry_points={
+        "console_scripts": [
+            "kinexon-backfill=bielemetrics_kinexon_api_wrapper.backfill:main",
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,270 @@
+import os
+import threading
+
+import pytest
+
+from bielemetrics_kinexon_api_wrapper import backfill
+
+
+class FakeClock:
+    """Replacement for the time module used by the backfill queue."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSession:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(backfill, "time", fake_clock)
+    return fake_clock
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+@pytest.fixture
+def conn(queue_path):
+    connection = backfill.open_work_queue(queue_path)
+    yield connection
+    connection.close()
+
+
+def test_enqueue_sessions_deduplicates(conn):
+    added = backfill.enqueue_sessions(
+        conn, [{"session_id": 1}, {"session_id": "1"}, {"session_id": 2}]
+    )
+    assert added == 2
+
+    assert backfill.enqueue_sessions(conn, [{"session_id": "1"}]) == 0
+    assert backfill.queue_progress(conn)["total"] == 2
+
+
+def test_claim_work_item_returns_claimed_state(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+
+    work_item = backfill.claim_work_item(conn, "w1", lease_seconds=10)
+
+    assert work_item["session_id"] == "1"
+    assert work_item["status"] == backfill.STATUS_CLAIMED
+    assert work_item["worker_id"] == "w1"
+    assert work_item["lease_expires_at"] == clock.now + 10
+    assert work_item["attempts"] == 1
+    assert backfill.claim_work_item(conn, "w2") is None
+
+
+def test_expired_lease_is_taken_over(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+    backfill.claim_work_item(conn, "w1", lease_seconds=10)
+
+    clock.sleep(5)
+    assert backfill.claim_work_item(conn, "w2", lease_seconds=10) is None
+
+    clock.sleep(6)
+    work_item = backfill.claim_work_item(conn, "w2", lease_seconds=10)
+    assert work_item["worker_id"] == "w2"
+    assert work_item["attempts"] == 2
+
+
+def test_old_lease_holder_cannot_renew_or_complete(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+    backfill.claim_work_item(conn, "w1", lease_seconds=10)
+    clock.sleep(11)
+    backfill.claim_work_item(conn, "w2", lease_seconds=10)
+
+    assert not backfill.renew_lease(conn, "1", "w1")
+    assert not backfill.complete_work_item(conn, "1", "w1", "old.csv")
+    assert backfill.renew_lease(conn, "1", "w2")
+    assert backfill.complete_work_item(conn, "1", "w2", "new.csv")
+
+    row = conn.execute("SELECT * FROM work_items").fetchone()
+    assert row["status"] == backfill.STATUS_DONE
+    assert row["output_path"] == "new.csv"
+
+
+def test_fail_work_item_backs_off_and_fails_at_max_attempts(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+
+    work_item = backfill.claim_work_item(conn, "w1", max_attempts=2)
+    assert backfill.fail_work_item(
+        conn, "1", "w1", "boom", work_item["attempts"], 2, retry_delay=30
+    )
+    row = conn.execute("SELECT * FROM work_items").fetchone()
+    assert row["status"] == backfill.STATUS_PENDING
+    assert row["available_at"] == clock.now + 30
+    assert backfill.claim_work_item(conn, "w1", max_attempts=2) is None
+
+    clock.sleep(30)
+    work_item = backfill.claim_work_item(conn, "w1", max_attempts=2)
+    assert work_item["attempts"] == 2
+    assert backfill.fail_work_item(
+        conn, "1", "w1", "boom", work_item["attempts"], 2, retry_delay=30
+    )
+    row = conn.execute("SELECT * FROM work_items").fetchone()
+    assert row["status"] == backfill.STATUS_FAILED
+    assert row["last_error"] == "boom"
+
+    assert not backfill.fail_work_item(conn, "1", "w1", "boom", 2, 2)
+
+
+def test_lease_expired_after_last_attempt_fails_item(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+    backfill.claim_work_item(conn, "w1", lease_seconds=10, max_attempts=1)
+
+    clock.sleep(11)
+    assert backfill.claim_work_item(conn, "w2", max_attempts=1) is None
+
+    row = conn.execute("SELECT * FROM work_items").fetchone()
+    assert row["status"] == backfill.STATUS_FAILED
+    assert row["last_error"] == "lease expired"
+
+
+def test_requeue_failed(conn, clock):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}, {"session_id": "2"}])
+    work_item = backfill.claim_work_item(conn, "w1", max_attempts=1)
+    backfill.fail_work_item(
+        conn, work_item["session_id"], "w1", "boom", 1, max_attempts=1
+    )
+
+    assert backfill.requeue_failed(conn) == 1
+    progress = backfill.queue_progress(conn)
+    assert progress[backfill.STATUS_PENDING] == 2
+    assert progress[backfill.STATUS_FAILED] == 0
+
+    work_item = backfill.claim_work_item(conn, "w1", max_attempts=1)
+    assert work_item["attempts"] == 1
+
+
+def test_concurrent_claims_are_exclusive(queue_path):
+    conn = backfill.open_work_queue(queue_path)
+    backfill.enqueue_sessions(
+        conn, [{"session_id": str(i)} for i in range(50)]
+    )
+    conn.close()
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        worker_conn = backfill.open_work_queue(queue_path)
+        while True:
+            work_item = backfill.claim_work_item(worker_conn, worker_id)
+            if work_item is None:
+                break
+            with lock:
+                claimed.append(work_item["session_id"])
+            backfill.complete_work_item(
+                worker_conn, work_item["session_id"], worker_id, "out.csv"
+            )
+        worker_conn.close()
+
+    threads = [
+        threading.Thread(target=worker, args=(f"w{i}",)) for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed, key=int) == [str(i) for i in range(50)]
+
+
+def test_heartbeat_survives_errors_and_reports_lost_lease(
+    monkeypatch, queue_path, conn
+):
+    backfill.enqueue_sessions(conn, [{"session_id": "1"}])
+    backfill.claim_work_item(conn, "w1", lease_seconds=0.03)
+    open_work_queue = backfill.open_work_queue
+    attempts = []
+
+    def flaky_open_work_queue(path):
+        attempts.append(path)
+        if len(attempts) == 1:
+            raise Exception("database is locked")
+        return open_work_queue(path)
+
+    monkeypatch.setattr(backfill, "open_work_queue", flaky_open_work_queue)
+    conn.execute("UPDATE work_items SET worker_id = 'w2'")
+    stop_event = threading.Event()
+    lease_lost = threading.Event()
+
+    backfill._heartbeat(queue_path, "1", "w1", 0.03, stop_event, lease_lost)
+
+    assert len(attempts) == 2
+    assert lease_lost.is_set()
+
+
+def test_run_worker_retries_and_cleans_up(
+    monkeypatch, tmp_path, queue_path, conn
+):
+    backfill.enqueue_sessions(
+        conn,
+        [
+            {"session_id": "1", "start_session": "2023-12-01 18:00:00"},
+            {"session_id": "2", "start_session": "2023-12-02 18:00:00"},
+        ],
+    )
+    calls = []
+    replace = os.replace
+
+    def fake_fetch_game_csv_data(session, base_url, session_id):
+        calls.append(session_id)
+        return b"csv"
+
+    def fake_replace(src, dst):
+        if dst.endswith("_2.csv"):
+            raise OSError("disk full")
+        replace(src, dst)
+
+    monkeypatch.setattr(backfill, "login", lambda credentials: FakeSession())
+    monkeypatch.setattr(
+        backfill, "fetch_game_csv_data", fake_fetch_game_csv_data
+    )
+    monkeypatch.setattr(backfill.os, "replace", fake_replace)
+    output_dir = str(tmp_path / "games")
+
+    stats = backfill.run_worker(
+        queue_path,
+        output_dir,
+        {"ENDPOINT_KINEXON_API": "https://example.invalid"},
+        worker_id="w1",
+        max_attempts=2,
+        retry_delay=0,
+        poll_interval=0.01,
+    )
+
+    assert stats == {"completed": 1, "failed": 1}
+    assert calls == ["1", "2", "2"]
+    assert os.listdir(output_dir) == [
+        "2023-12-01_18-00-00_game_positions_1.csv"
+    ]
+    progress = backfill.queue_progress(conn)
+    assert progress[backfill.STATUS_DONE] == 1
+    assert progress[backfill.STATUS_FAILED] == 1
+
+
+def test_main_rejects_non_positive_lease(queue_path):
+    with pytest.raises(SystemExit):
+        backfill.main(
+            [
+                "--queue",
+                queue_path,
+                "work",
+                "--output-dir",
+                "games",
+                "--lease-seconds",
+                "0",
+            ]
+        )